@@ -24,14 +24,18 @@
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 # Author: Michael Simacek <msimacek@redhat.com>
 
+import functools
 import os
 import re
 import logging
+import threading
 import koji
 import hawkey
 import jinja2
 
-from textwrap import dedent, fill
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from textwrap import dedent
 
 from koschei import config
 try:
@@ -42,10 +46,14 @@ from koschei.backend import koji_util, depsolve, repo_cache
 
 log = logging.getLogger('')
 
+_NVRA_RE = re.compile(r'^(.+)-([^-]+)-([^-]+)\.([^-.]+)\.rpm$')
+_HEAD_RE = re.compile(r'ref: refs/heads/(.*)')
+_SCM_REF_RE = re.compile(r'#([0-9a-f]{7})[0-9a-f]*$')
+
 # Use git repo name and branch for module/stream.
 module = os.path.basename(os.getcwd())
 with open('.git/HEAD') as f:
-    stream = re.match(r'ref: refs/heads/(.*)', f.readlines()[0]).group(1)
+    stream = _HEAD_RE.match(f.read()).group(1).rstrip()
 
 config.load_config(['koschei.cfg'], ignore_env=True)
 
@@ -54,22 +62,28 @@ default_ref = config.get_config('default_ref')
 include_build_deps = config.get_config('include_build_deps')
 api = config.get_config('api')
 profiles = config.get_config('profiles')
-includes = config.get_config('includes')
-excludes = config.get_config('excludes')
-frozen_refs = config.get_config('frozen_refs')
+includes = frozenset(config.get_config('includes'))
+excludes = set(config.get_config('excludes'))
+frozen_refs = frozenset(config.get_config('frozen_refs'))
 stream_override = config.get_config('stream_override')
 macros = config.get_config('macros', None)
 
 ks = koji_util.KojiSession()
 
+# How many Koji sessions to drive concurrently for batched calls.
+koji_workers = int(os.environ.get('KOSCHEI_KOJI_WORKERS', '8'))
+_worker_tls = threading.local()
+
 tag_name = config.get_koji_config('primary', 'tag_name')
 repo_id = ks.getRepo(tag_name, state=koji.REPO_READY)['id']
 repo_descriptor = KojiRepoDescriptor('primary', tag_name, repo_id)
 
 
-# Parse RPM name - split it into NVRA dict
+# Parse RPM name - split it into NVRA dict. Memoized - the same SRPM
+# names are parsed over and over in the resolution loops.
+@functools.lru_cache(maxsize=None)
 def parse_nvra(str):
-    m = re.match(r'^(.+)-([^-]+)-([^-]+)\.([^-.]+).rpm$', str)
+    m = _NVRA_RE.match(str)
     return {'name': m.group(1), 'version': m.group(2),
             'release': m.group(3), 'arch': m.group(4)}
 
@@ -79,22 +93,34 @@ def name(rpm):
     return parse_nvra(rpm)['name']
 
 
+_DEBUG_SUFFIXES = ('-debuginfo', '-debugsource')
+
+_MAVEN_PREFIXES = ('/usr/share/maven-metadata/',
+                   '/usr/share/java/',
+                   '/usr/lib/java/')
+
+
+# Results of the file-list scan, keyed by package NEVRA. Packages keep
+# reappearing in the installs of later resolution rounds and hawkey
+# loads file lists lazily, so scanning each package once is enough.
+_maven_files_cache = {}
+
+
 # Try to heuristically guess whether given hawkey package is Java package and
 # should be part of maven module, or not. Explicit includes and excludes always
 # have preference over heuristic.
 def is_maven_pkg(pkg):
-    if name(pkg.sourcerpm) in includes:
+    srpm_name = name(pkg.sourcerpm)
+    if srpm_name in includes:
         return True
-    if name(pkg.sourcerpm) in excludes:
+    if srpm_name in excludes:
         return False
-    for file in pkg.files:
-        if file.startswith('/usr/share/maven-metadata/'):
-            return True
-        if file.startswith('/usr/share/java/'):
-            return True
-        if file.startswith('/usr/lib/java/'):
-            return True
-    return False
+    key = str(pkg)
+    maven = _maven_files_cache.get(key)
+    if maven is None:
+        maven = any(file.startswith(_MAVEN_PREFIXES) for file in pkg.files)
+        _maven_files_cache[key] = maven
+    return maven
 
 
 # Simulate installation of given dependencies.
@@ -115,16 +141,36 @@ def resolve_deps(sack, deps):
     return java, set(installs)
 
 
+# Matched packages per BuildRequires string, cached for the same
+# reason as _reldep_cache below.
+_builddep_cache = {}
+
+
 # Input: BuildRequires string
 # Output: matched hawkey packages
 def resolve_builddep(sack, br):
-    return depsolve._get_builddep_selector(sack, br).matches()
+    matches = _builddep_cache.get(br)
+    if matches is None:
+        matches = _builddep_cache[br] = \
+            list(depsolve._get_builddep_selector(sack, br).matches())
+    return matches
+
+
+# Matched packages per reldep string. The sack is the same for the whole
+# run, so results never go stale. Keyed by str(reldep) because hawkey
+# Reldep objects are distinct per owning package.
+_reldep_cache = {}
 
 
 # Input: hawkey reldep
 # Output: matched hawkey packages
 def resolve_reldep(sack, reldep):
-    return hawkey.Query(sack).filter(provides=reldep)
+    key = str(reldep)
+    matches = _reldep_cache.get(key)
+    if matches is None:
+        matches = _reldep_cache[key] = \
+            list(hawkey.Query(sack).filter(provides=reldep))
+    return matches
 
 
 # Get build-requires of given SRPMs from Koji.
@@ -133,45 +179,124 @@ def get_build_requires(srpms):
     return koji_util.get_rpm_requires(ks, [parse_nvra(srpm) for srpm in srpms])
 
 
+# Like koji_util.itercall, but splits the items into chunks dispatched
+# over a thread pool so that the Koji round-trips overlap. Koji sessions
+# are not thread-safe, so each worker thread lazily opens its own
+# session. Results are yielded in input order.
+def itercall_parallel(items, fn, chunk_size=50):
+    items = list(items)
+
+    def call_chunk(session, chunk):
+        # Pack the whole chunk into a single multicall HTTP request.
+        # Old koji clients have no multicall context manager (the name
+        # is just the legacy boolean flag there) - fall back to the
+        # chunked itercall in that case.
+        if callable(getattr(session, 'multicall', None)):
+            with session.multicall(batch=chunk_size) as m:
+                calls = [fn(m, item) for item in chunk]
+            return [call.result for call in calls]
+        return list(koji_util.itercall(session, chunk, fn))
+
+    if len(items) <= chunk_size or koji_workers < 2:
+        yield from call_chunk(ks, items)
+        return
+
+    def worker(chunk):
+        session = getattr(_worker_tls, 'session', None)
+        if session is None:
+            session = _worker_tls.session = koji_util.KojiSession()
+        return call_chunk(session, chunk)
+
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    with ThreadPoolExecutor(max_workers=koji_workers) as pool:
+        for results in pool.map(worker, chunks):
+            yield from results
+
+
+# Cache of Koji build records, keyed by SRPM file name. Shared between
+# get_binary_rpms and resolve_refs so that each SRPM is looked up in
+# Koji at most once, no matter how many resolution rounds ask for it.
+_build_cache = {}
+
+
+# Get Koji build records for given SRPMs, querying Koji only for SRPMs
+# not seen before.
+def get_builds(srpms):
+    misses = [srpm for srpm in srpms if srpm not in _build_cache]
+    if misses:
+        builds = itercall_parallel(misses, lambda ks, srpm: ks.getBuild(parse_nvra(srpm)))
+        _build_cache.update(zip(misses, builds))
+    return [_build_cache[srpm] for srpm in srpms]
+
+
+# Binary RPM names per SRPM. get_binary_rpms runs once per resolution
+# round and is then called again with all of srpms_done for the filter
+# checks, so without the cache most SRPMs would hit Koji twice.
+_binary_rpms_cache = {}
+
+
 # Get names of binary RPMs corresponding to given list of source RPMs.
 def get_binary_rpms(srpms):
+    srpms = list(srpms)
+    misses = [srpm for srpm in srpms if srpm not in _binary_rpms_cache]
+    if misses:
+        builds = get_builds(misses)
+        rpms_gen = itercall_parallel(builds, lambda ks, build: ks.listRPMs(build['id'], arches=('noarch', 'x86_64')))
+        for srpm, rpms in zip(misses, rpms_gen):
+            _binary_rpms_cache[srpm] = {rpm['name'] for rpm in rpms if not rpm['name'].endswith(_DEBUG_SUFFIXES)}
     rpm_names = set()
-    builds = koji_util.itercall(ks, list(srpms), lambda ks, srpm: ks.getBuild(parse_nvra(srpm)))
-    rpms_gen = koji_util.itercall(ks, list(builds), lambda ks, build: ks.listRPMs(build['id'], arches=('noarch', 'x86_64')))
-    for rpms in rpms_gen:
-        rpm_names.update([rpm['name'] for rpm in rpms if not rpm['name'].endswith('-debuginfo') and not rpm['name'].endswith('-debugsource')])
+    for srpm in srpms:
+        rpm_names |= _binary_rpms_cache[srpm]
     return rpm_names
 
 
 def topo_sort(V, E):
+    # Kahn's algorithm. Count for each node how many of its dependencies
+    # are still unprocessed, then repeatedly emit the nodes whose count
+    # dropped to zero, one wavefront per buildorder level.
+    indeg = {v: 0 for v in V}
+    for u, succs in E.items():
+        if u in indeg:
+            for s in succs:
+                if s in indeg:
+                    indeg[s] += 1
     W = {}
     i = 1
-    while V:
-        U = set()
-        for v in V:
-            for u in V:
-                if v in E.get(u, ()):
-                    break
-            else:
-                W[v] = i
-                U.add(v)
-        if not U:
-            log.error('There are dependency cycles, topological sort is not possible')
-            return None
-        V = V - U
+    queue = deque(v for v in indeg if indeg[v] == 0)
+    while queue:
+        for _ in range(len(queue)):
+            v = queue.popleft()
+            W[v] = i
+            for s in E.get(v, ()):
+                if s in indeg:
+                    indeg[s] -= 1
+                    if indeg[s] == 0:
+                        queue.append(s)
         i += 1
+    if len(W) < len(V):
+        log.error('There are dependency cycles, topological sort is not possible')
+        return None
     return W
 
 
 # For each SRPM, figure out from which git commit it was built.
 def resolve_refs(srpms):
     def get_ref(build):
-        scm_url = build['extra']['source']['original_url']
-        match = re.search(r'#([0-9a-f]{7})[0-9a-f]*$', scm_url)
-        assert match
-        return match.group(1)
-    builds = koji_util.itercall(ks, list(srpms), lambda ks, srpm: ks.getBuild(parse_nvra(srpm)))
-    return {srpm: get_ref(build) for srpm, build in zip(srpms, builds)}
+        # Older builds may lack the SCM URL in build extra - leave such
+        # SRPMs out so the template falls back to default_ref.
+        scm_url = ((build.get('extra') or {}).get('source') or {}).get('original_url')
+        if not scm_url:
+            return None
+        match = _SCM_REF_RE.search(scm_url)
+        return match.group(1) if match else None
+    srpms = list(srpms)
+    builds = get_builds(srpms)
+    refs = {}
+    for srpm, build in zip(srpms, builds):
+        ref = get_ref(build)
+        if ref:
+            refs[srpm] = ref
+    return refs
 
 
 # Do the main work. Recursively resolve requires and build-requires, starting
@@ -179,14 +304,10 @@ def resolve_refs(srpms):
 def work(sack):
     filtered = set(config.get_config('filter'))
     srpms_done = set()
-    br_map = {}
+    br_seen = set()
+    br_map = defaultdict(set)
     srpms_todo, pkgs = resolve_deps(sack, api)
 
-    def add(map, key, val):
-        _set = map.get(key, set())
-        map[key] = _set
-        _set.add(val)
-
     while srpms_todo:
         log.info('Round: {} packages'.format(len(srpms_todo)))
         srpms_todo = {srpm for srpm in srpms_todo
@@ -197,9 +318,14 @@ def work(sack):
             for srpm, build_requires in zip(srpms_todo, get_build_requires(srpms_todo)):
                 combined_br |= set(build_requires)
                 for br in build_requires:
-                    add(br_map, br, srpm)
+                    br_map[br].add(srpm)
         if config.get_config('closure'):
             combined_br.update(get_binary_rpms(srpms_todo) - filtered)
+        # Only depsolve requirements not seen in previous rounds - common
+        # build-requires like maven-local recur in every round and their
+        # installs are already part of pkgs.
+        combined_br -= br_seen
+        br_seen |= combined_br
         java, all = resolve_deps(sack, combined_br)
         srpms_todo |= java
         srpms_todo -= srpms_done
@@ -208,7 +334,18 @@ def work(sack):
     def our(pkgs):
         return (pkg for pkg in pkgs if pkg.sourcerpm in srpms_done)
 
-    api_srpms = {pkg.sourcerpm for pkg in pkgs if pkg.name in api}
+    # Bucket resolved packages by source RPM once - the API scan and the
+    # runtime dependency pass below would otherwise each rescan the full
+    # package set, and attribute access on hawkey packages is not cheap.
+    pkgs_by_srpm = defaultdict(list)
+    for pkg in pkgs:
+        pkgs_by_srpm[pkg.sourcerpm].append(pkg)
+    our_pkgs = [pkg for srpm in srpms_done
+                for pkg in pkgs_by_srpm.get(srpm, ())]
+
+    api_set = frozenset(api)
+    api_srpms = {srpm for srpm, subpkgs in pkgs_by_srpm.items()
+                 if any(pkg.name in api_set for pkg in subpkgs)}
 
     if filtered:
         for pkg in filtered - get_binary_rpms(srpms_done):
@@ -223,27 +360,34 @@ def work(sack):
         else:
             return '{} (subpackage of {})'.format(rpm.name, name(rpm.sourcerpm))
 
-    build_deps = {}
+    build_deps = defaultdict(set)
     for br, srpms in br_map.items():
         for dep in our(resolve_builddep(sack, br)):
             for srpm in srpms:
                 if dep.name in filtered:
                     log.warning('Build dependency broken by filter: component {} BuildRequires "{}", which pulls in filtered RPM {}.'
                                 .format(name(srpm), br, pretty_rpm_name(dep)))
-                add(build_deps, dep.sourcerpm, srpm)
+                build_deps[dep.sourcerpm].add(srpm)
 
-    runtime_deps = {}
-    for pkg in our(pkgs):
+    runtime_deps = defaultdict(set)
+    for pkg in our_pkgs:
         for reldep in pkg.requires:
             for dep in resolve_reldep(sack, reldep):
                 if dep.name in filtered and pkg.name not in filtered:
                     log.warning('Runtime dependency broken by filter: package {} Requires "{}", which pulls in filtered RPM {}.'
                                 .format(pretty_rpm_name(pkg), reldep, pretty_rpm_name(dep)))
                 if dep.sourcerpm != pkg.sourcerpm:
-                    add(runtime_deps, dep.sourcerpm, pkg.sourcerpm)
+                    runtime_deps[dep.sourcerpm].add(pkg.sourcerpm)
 
+    buildorder = None
     if config.get_config('topo_sort', False):
-        buildorder = topo_sort(srpms_done, {**runtime_deps, **build_deps})
+        # Merge edge sets of SRPMs present in both maps - {**a, **b}
+        # would silently drop the runtime edges of such SRPMs.
+        combined_deps = defaultdict(set)
+        for deps in (runtime_deps, build_deps):
+            for srpm, dependents in deps.items():
+                combined_deps[srpm].update(dependents)
+        buildorder = topo_sort(srpms_done, combined_deps)
 
     log.info('Resolving git refs...')
     if full_refs:
@@ -251,10 +395,24 @@ def work(sack):
     else:
         refs = resolve_refs([srpm for srpm in srpms_done if name(srpm) in frozen_refs])
 
-    def get_stream(dep):
-        return stream_override.get(dep, {}).get(stream, stream)
+    context = {
+        'api': api,
+        'filtered': filtered,
+        'srpms_done': srpms_done,
+        'api_srpms': api_srpms,
+        'runtime_deps': runtime_deps,
+        'build_deps': build_deps,
+        'refs': refs,
+    }
+    if buildorder is not None:
+        context['buildorder'] = buildorder
+    content = _modulemd_template.render(context)
 
-    yaml = dedent("""\
+    with open('{}.yaml'.format(module), 'w') as f:
+        f.write(content)
+
+
+_MODULEMD_TEMPLATE = dedent("""\
     {% macro format_rationale(type, srpms, cont_indent) %}
     {% filter wrap(width=(80 - cont_indent)) | indent(cont_indent) %}
     {{ type }} of {{ sorted(srpms) | map('name') | join(', ') }}.
@@ -331,19 +489,50 @@ def work(sack):
                 {% endfor %}
     """)
 
-    env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
-    env.globals.update(vars(__builtins__))
-    env.globals.update(globals())
-    env.filters['name'] = name
-
-    def wrap(text, width):
-        return fill(text, width, break_on_hyphens=False, break_long_words=False)
 
-    env.filters['wrap'] = wrap
-    content = env.from_string(yaml).render(**locals())
-
-    with open('{}.yaml'.format(module), 'w') as f:
-        f.write(content)
+# Greedy single-pass line breaker. Rationale text is space-separated
+# package names, so this matches what textwrap.fill(break_on_hyphens=False,
+# break_long_words=False) produced, without re-splitting the text with
+# regexes on every call.
+def wrap(text, width):
+    lines = []
+    line = ''
+    for word in text.split():
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = word
+        elif line:
+            line = '{} {}'.format(line, word)
+        else:
+            line = word
+    if line:
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+# Map module-level dependency to stream, respecting overrides for the
+# current stream.
+def get_stream(dep):
+    return stream_override.get(dep, {}).get(stream, stream)
+
+
+# Compile the template once at import time - re-tokenizing it (and its
+# macro) on every work() call is wasted startup work. The globals are an
+# explicit whitelist of what the template references - injecting
+# vars(__builtins__) and globals() wholesale made every template symbol
+# lookup walk a 150+ entry dict and exposed eval/exec to the template.
+_jinja_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+_jinja_env.filters['name'] = name
+_jinja_env.filters['wrap'] = wrap
+_jinja_env.globals.update(
+    sorted=sorted,
+    config=config,
+    get_stream=get_stream,
+    profiles=profiles,
+    macros=macros,
+    default_ref=default_ref,
+)
+_modulemd_template = _jinja_env.from_string(_MODULEMD_TEMPLATE)
 
 
 # Get set of components contained withing given module/stream in Koji.
@@ -368,7 +557,7 @@ def main():
     if not os.path.exists('/tmp/maven-modulemd-gen/repodata'):
         os.makedirs('/tmp/maven-modulemd-gen/repodata')
     for module_coords in config.get_config('module_excludes', []):
-        excludes.extend(get_module_components(*module_coords))
+        excludes.update(get_module_components(*module_coords))
     log.info('Loading sack...')
     with repo_cache.RepoCache().get_sack(repo_descriptor) as sack:
         work(sack)